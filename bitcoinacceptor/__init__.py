@@ -8,20 +8,28 @@ Or Bitcoin Cash, Bitcoin SV, or Monero!
 Released into the public domain.
 """
 import logging
+import time
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
 from hashlib import md5, sha1
 
 import bit
 import bitcash
 import bitsv
-import requests
 from sporestackv2 import utilities
 from monero.wallet import Wallet
 from monero.backends.jsonrpc import JSONRPCWallet
+from monero.backends.offline import OfflineWallet
 from monero.numbers import from_atomic
 
+from . import cache, explorer, transport
+
 logging.basicConfig(level=logging.INFO)
 
+# So bit, bitcash and bitsv share our connection pools.
+transport.install()
+
 # Only for BTC, BCH, and BSV
 MIN_CONFIRMATIONS = 1
 MAX_CONFIRMATIONS = 6
@@ -35,6 +43,29 @@ VALID_CURRENCIES = ("btc", "bch", "bsv", "xmr")
 # For Monero's fiat_per_coin
 GET_TIMEOUT = 30
 
+# Optional sqlite file for rates, unspents and Monero subaddresses so they
+# survive a restart. None disables caching entirely.
+CACHE_PATH = None
+# Seconds
+RATE_TTL = 60
+UNSPENTS_TTL = 10
+
+# Optional callable(address, currency) returning [amount, txid, confirmations]
+# lists, used instead of the explorers. Handy for simulations and tests.
+UNSPENTS_BACKEND = None
+
+# Currency to Esplora API endpoint, like {"btc": "https://blockstream.info/api/"}.
+# Currencies in here skip bit/bitcash/bitsv and stream unspents from the
+# explorer instead, see bitcoinacceptor.explorer.
+ESPLORA_ENDPOINTS = {}
+
+# How many Monero subaddresses uniques are spread over. Your wallet's
+# lookahead has to cover this, see _monero_security_code(). Can be set per
+# wallet with "subaddress_lookahead" in monero_rpc. Changing it moves
+# existing uniques to other subaddresses, so only do that with no Monero
+# invoices open.
+MONERO_SUBADDRESS_LOOKAHEAD = 199
+
 
 def validate_currency(currency):
     msg = "currency must be one of: {}".format(VALID_CURRENCIES)
@@ -45,7 +76,7 @@ def validate_currency(currency):
 
 def _xmr_to_fiat():
     url = "https://min-api.cryptocompare.com/data/price?fsym=XMR&tsyms=USD"
-    request = requests.get(url=url, timeout=GET_TIMEOUT)
+    request = transport.get(url, timeout=GET_TIMEOUT)
     request.raise_for_status()
     request_dict = request.json()
     return request_dict["USD"]
@@ -59,8 +90,19 @@ def fiat_per_coin(currency):
     of this comment)
 
     'currency' is the cryptocurrency, not the fiat.
+
+    Cached for RATE_TTL seconds if CACHE_PATH is set.
     """
     validate_currency(currency)
+    rate = cache.load(CACHE_PATH, "rate", currency)
+    if rate is not None:
+        return rate
+    rate = _fiat_per_coin(currency)
+    cache.store(CACHE_PATH, "rate", currency, rate, ttl=RATE_TTL)
+    return rate
+
+
+def _fiat_per_coin(currency):
     if currency == "bch":
         BCH = bitcash.network.rates.BCH
         return float(bitcash.network.rates.satoshi_to_currency(BCH, "usd"))
@@ -103,7 +145,7 @@ def satoshis_per_cent(currency="btc", first_price=None, second_price=None):
     return satoshis_per_cent_list
 
 
-def _monero_security_code(unique):
+def _monero_security_code(unique, lookahead=MONERO_SUBADDRESS_LOOKAHEAD):
     """
     So, there's this:
     https://monero.stackexchange.com/questions/10184/
@@ -113,7 +155,16 @@ def _monero_security_code(unique):
     I guess that's too much.
 
     For now, let's just do 200.
+
+    You can go bigger with lookahead, but only if your wallet RPC was started
+    with a matching --subaddress-lookahead, like 1:100000. Otherwise it won't
+    see payments to the higher subaddresses.
+
+    Any lookahead but 199 maps uniques to different subaddresses, so payments
+    to open invoices would be missed after changing it.
     """
+    if lookahead < 1 or lookahead > 2**32:
+        raise ValueError("lookahead must be between 1 and 2**32")
     hashable = bytes(unique, "utf-8")
     unique_hash = sha1(hashable).hexdigest()
     # each part is 32 bits, so take that much.
@@ -122,33 +173,123 @@ def _monero_security_code(unique):
     security_code_major = 0
     # 0:1 wasn't giving me 0-255??? Weird.
     # 199 just in case it's 0-199 and not 0-200.
-    security_code_minor = int(unique_hash[0:3], 16) % 199
+    if lookahead <= 0xFFF:
+        # Same 12 bits as always so existing invoices keep their subaddress.
+        security_code_minor = int(unique_hash[0:3], 16) % lookahead
+    else:
+        security_code_minor = int(unique_hash[0:8], 16) % lookahead
     return (security_code_major, security_code_minor)
 
 
-def _monero_unspents(unique, piconero_to_try, txids, host, port, user, password):
+def _monero_subaddress(major, minor, wallet_address, view_key):
+    """
+    Derives a subaddress locally from the wallet's primary address and secret
+    view key. No RPC needed.
+    """
+    w = Wallet(OfflineWallet(wallet_address, view_key=view_key))
+    return str(w.get_address(major, minor))
+
+
+def precompute_monero_subaddresses(monero_rpc, lookahead=None):
+    """
+    Fills the cache with every subaddress a unique can map to, both
+    subaddress to index and index to subaddress.
+
+    monero_rpc needs "address" (the primary address) and "view_key" (the
+    secret view key) for this. Requires CACHE_PATH.
+
+    Returns how many subaddresses were stored.
+    """
+    if CACHE_PATH is None:
+        raise ValueError("CACHE_PATH must be set to precompute subaddresses.")
+    if "address" not in monero_rpc or "view_key" not in monero_rpc:
+        raise ValueError("monero_rpc must have address and view_key.")
+    if lookahead is None:
+        lookahead = monero_rpc.get("subaddress_lookahead", MONERO_SUBADDRESS_LOOKAHEAD)
+    wallet_address = monero_rpc["address"]
+    w = Wallet(OfflineWallet(wallet_address, view_key=monero_rpc["view_key"]))
+    major = 0
+    subaddresses = []
+    indexes = []
+    for minor in range(lookahead):
+        subaddress = str(w.get_address(major, minor))
+        subaddresses.append((f"{wallet_address}:{major}:{minor}", subaddress))
+        indexes.append((subaddress, [major, minor]))
+    cache.store_many(CACHE_PATH, "xmr_subaddress", subaddresses)
+    cache.store_many(CACHE_PATH, "xmr_subaddress_index", indexes)
+    return lookahead
+
+
+def monero_subaddress_index(subaddress):
+    """
+    Returns (major, minor) for a subaddress from the precomputed table, or
+    None if it's not in there.
+    """
+    index = cache.load(CACHE_PATH, "xmr_subaddress_index", subaddress)
+    if index is None:
+        return None
+    return tuple(index)
+
+
+def _monero_unspents(
+    unique,
+    piconero_to_try,
+    txids,
+    host,
+    port,
+    user,
+    password,
+    wallet_address=None,
+    view_key=None,
+    lookahead=MONERO_SUBADDRESS_LOOKAHEAD,
+):
     """
     Get incoming transactions from Monero RPC and see if we have a winner.
 
     unique is used to get us a specific address for the unique.
 
+    If wallet_address and view_key are given, the subaddress is derived
+    locally instead of asking the wallet.
+
     No satoshi security here since we have unique addresses.
     """
-    proxy_url = None
-    if host.endswith(".onion"):
-        proxy_url = "socks5h://127.0.0.1:9050"
-    w = Wallet(
-        JSONRPCWallet(
-            host=host, port=port, user=user, password=password, proxy_url=proxy_url
-        )
+    backend = JSONRPCWallet(
+        host=host, port=port, user=user, password=password, timeout=transport.TIMEOUT
     )
-    security_code_major, security_code_minor = _monero_security_code(unique)
-    unique_address = w.get_address(security_code_major, security_code_minor)
-    return_address = str(unique_address)
+    # Proxying (like for .onion wallets) is up to transport.SOCKS_PROXY.
+    # The backend's own proxies would override the session's otherwise.
+    backend.session = transport.session()
+    backend.proxies = transport.proxies()
+    w = Wallet(backend)
+    security_code_major, security_code_minor = _monero_security_code(unique, lookahead)
+    return_address = None
+    # Subaddresses never change for a given wallet, so keep them forever.
+    # Keyed on the primary address, not host and port, so a different wallet
+    # behind the same RPC never gets handed the old one's subaddresses. Only
+    # worth an RPC for the primary address if we're caching.
+    if CACHE_PATH is not None:
+        if wallet_address is None:
+            wallet_address_key = str(w.address())
+        else:
+            wallet_address_key = wallet_address
+        subaddress_key = (
+            f"{wallet_address_key}:{security_code_major}:{security_code_minor}"
+        )
+        return_address = cache.load(CACHE_PATH, "xmr_subaddress", subaddress_key)
+    if return_address is None:
+        if wallet_address is not None and view_key is not None:
+            return_address = _monero_subaddress(
+                security_code_major, security_code_minor, wallet_address, view_key
+            )
+        else:
+            unique_address = w.get_address(security_code_major, security_code_minor)
+            return_address = str(unique_address)
+        if CACHE_PATH is not None:
+            cache.store(CACHE_PATH, "xmr_subaddress", subaddress_key, return_address)
     # Allow last 100 blocks. (200 minutes average)
     minimum_height = w.height() - 100
     incoming_tx = w.incoming(
-        local_address=unique_address,
+        local_address=return_address,
         min_height=minimum_height,
         confirmed=True,
         unconfirmed=False,
@@ -162,6 +303,83 @@ def _monero_unspents(unique, piconero_to_try, txids, host, port, user, password)
     return (return_address, False)
 
 
+def _upstream_unspents(address, currency):
+    """
+    Returns a list of [amount, txid, confirmations] for address, straight
+    from Esplora or bit/bitcash/bitsv. No caching or UNSPENTS_BACKEND.
+
+    Anything past MAX_CONFIRMATIONS is dropped since we'd never match on it.
+    """
+    if currency == "btc":
+        our_bit = bit
+    elif currency == "bch":
+        our_bit = bitcash
+    elif currency == "bsv":
+        our_bit = bitsv
+    else:
+        raise ValueError("_unspents is only for btc, bch, and bsv.")
+
+    if currency in ESPLORA_ENDPOINTS:
+        return [
+            list(unspent)
+            for unspent in explorer.fetch_unspents(
+                ESPLORA_ENDPOINTS[currency], address, 0, MAX_CONFIRMATIONS
+            )
+        ]
+    # bitsv has switched to get_unspents(). This is kind of hacky.
+    # https://github.com/AustEcon/bitsv/issues/40
+    if "get_unspents" in dir(our_bit.network.NetworkAPI):
+        raw_unspents = our_bit.network.NetworkAPI("main").get_unspents(address)
+    else:
+        raw_unspents = our_bit.network.NetworkAPI.get_unspent(address)
+    return [
+        [unspent.amount, unspent.txid, unspent.confirmations]
+        for unspent in raw_unspents
+        if unspent.confirmations <= MAX_CONFIRMATIONS
+    ]
+
+
+def _fetch_unspents(address, currency, min_confirmations=0, wanted=(), txids=()):
+    """
+    Returns (amount, txid, confirmations) for each unspent on address.
+
+    Anything past MAX_CONFIRMATIONS is dropped since we'd never match on it.
+    Cached for UNSPENTS_TTL seconds if CACHE_PATH is set.
+
+    min_confirmations, wanted (amounts) and txids only narrow down Esplora
+    lookups, and only when not caching. Those stop at the first wanted
+    amount not in txids.
+    """
+    if currency not in ("btc", "bch", "bsv"):
+        raise ValueError("_unspents is only for btc, bch, and bsv.")
+
+    cache_key = f"{currency}:{address}"
+    unspents = cache.load(CACHE_PATH, "unspents", cache_key)
+    if unspents is not None:
+        return unspents
+
+    if UNSPENTS_BACKEND is not None:
+        unspents = [
+            unspent
+            for unspent in UNSPENTS_BACKEND(address, currency)
+            if unspent[2] <= MAX_CONFIRMATIONS
+        ]
+    elif currency in ESPLORA_ENDPOINTS and CACHE_PATH is None:
+        # Nobody else will see these, so only keep what this lookup needs.
+        return explorer.fetch_unspents(
+            ESPLORA_ENDPOINTS[currency],
+            address,
+            min_confirmations,
+            MAX_CONFIRMATIONS,
+            wanted,
+            txids,
+        )
+    else:
+        unspents = _upstream_unspents(address, currency)
+    cache.store(CACHE_PATH, "unspents", cache_key, unspents, ttl=UNSPENTS_TTL)
+    return unspents
+
+
 def _unspents(
     address,
     satoshis_to_try,
@@ -177,38 +395,26 @@ def _unspents(
 
     Unspents for Bitcoin, Bitcoin Cash, or Bitcoin SV.
     """
-    if currency == "btc":
-        our_bit = bit
-    elif currency == "bch":
-        our_bit = bitcash
-    elif currency == "bsv":
-        our_bit = bitsv
-    else:
-        raise ValueError("_unspents is only for btc, bch, and bsv.")
-
     if isinstance(satoshis_to_try, int):
         satoshis_to_try = [satoshis_to_try]
-    # bitsv has switched to get_unspents(). This is kind of hacky.
-    # https://github.com/AustEcon/bitsv/issues/40
-    if "get_unspents" in dir(our_bit.network.NetworkAPI):
-        unspents = our_bit.network.NetworkAPI("main").get_unspents(address)
-    else:
-        unspents = our_bit.network.NetworkAPI.get_unspent(address)
-    for unspent in unspents:
+    security_code = _satoshi_security_code(unique)
+    wanted = {satoshis + security_code for satoshis in satoshis_to_try}
+    unspents = _fetch_unspents(address, currency, min_confirmations, wanted, txids)
+    for amount, txid, confirmations in unspents:
         # By doing continue instead of break, it can be slower but we should
         # be able to work with unsorted unspents.
-        if unspent.confirmations > MAX_CONFIRMATIONS:
+        if confirmations > MAX_CONFIRMATIONS:
             continue
-        if unspent.confirmations < min_confirmations:
+        if confirmations < min_confirmations:
             continue
         for satoshis in satoshis_to_try:
-            paid_satoshis = _satoshi_security_code(unique)
+            paid_satoshis = security_code
             paid_satoshis += satoshis
-            if unspent.amount == paid_satoshis:
-                if unspent.txid not in txids:
-                    return (unspent.txid, unspent.amount)
+            if amount == paid_satoshis:
+                if txid not in txids:
+                    return (txid, amount)
     # If nothing matches...
-    now_satoshis = satoshis_to_try[0] + _satoshi_security_code(unique)
+    now_satoshis = satoshis_to_try[0] + security_code
     # txid, satoshis
     return (False, now_satoshis)
 
@@ -302,7 +508,8 @@ def payment(
             raise ValueError("address must be none when using Monero (XMR)")
         if not isinstance(monero_rpc, dict):
             msg = "With currency set to xmr, monero_rpc must be a dict with "
-            msg += "host, port, user, password"
+            msg += "host, port, user, password and optionally address, view_key "
+            msg += "and subaddress_lookahead"
             raise ValueError(msg)
         address, txid = _monero_unspents(
             unique=unique,
@@ -312,6 +519,11 @@ def payment(
             port=monero_rpc["port"],
             user=monero_rpc["user"],
             password=monero_rpc["password"],
+            wallet_address=monero_rpc.get("address"),
+            view_key=monero_rpc.get("view_key"),
+            lookahead=monero_rpc.get(
+                "subaddress_lookahead", MONERO_SUBADDRESS_LOOKAHEAD
+            ),
         )
         satoshis = satoshis_to_try[0]
     else:
@@ -354,6 +566,27 @@ def fiat_payment(
     address should be None for Monero.
     """
     validate_currency(currency)
+    satoshis_to_try, hit_floor = _fiat_satoshis_to_try(
+        currency, cents, first_price, second_price
+    )
+    return payment(
+        address,
+        satoshis_to_try,
+        unique,
+        currency,
+        txids,
+        monero_rpc,
+        min_confirmations=min_confirmations,
+        hit_floor=hit_floor,
+        price=first_price,
+    )
+
+
+def _fiat_satoshis_to_try(currency, cents, first_price, second_price):
+    """
+    Returns (satoshis_to_try, hit_floor) for fiat_payment(), before the
+    security code.
+    """
     # Did we hit the price floor?
     hit_floor = False
     first_cents, second_cents = satoshis_per_cent(currency, first_price, second_price)
@@ -384,15 +617,78 @@ def fiat_payment(
         satoshis_to_try = [first_satoshis]
     else:
         satoshis_to_try = [first_satoshis, second_satoshis]
+    return (satoshis_to_try, hit_floor)
 
-    return payment(
-        address,
-        satoshis_to_try,
-        unique,
-        currency,
-        txids,
-        monero_rpc,
-        min_confirmations=min_confirmations,
-        hit_floor=hit_floor,
-        price=first_price,
-    )
+
+def multi_fiat_payment(
+    cents,
+    unique,
+    destinations,
+    prices={},
+    txids=[],
+    min_confirmations=MIN_CONFIRMATIONS,
+    deadline=GET_TIMEOUT,
+):
+    """
+    Runs fiat_payment() for several currencies at once, for checkout pages
+    that offer a few side by side.
+
+    destinations is a dict of currency to address, or to the monero_rpc dict
+    for xmr.
+
+    prices is an optional dict of currency to (first_price, second_price).
+    Any currency not in there gets its rate fetched.
+
+    deadline is in seconds, either one number for all currencies or a dict
+    of currency to seconds.
+
+    Returns a dict of currency to a namedtuple with status and payment.
+    status is "ok", "pending" if the deadline passed first or "error" if
+    the lookup blew up. payment is None unless status is "ok".
+    """
+    for currency in destinations:
+        validate_currency(currency)
+    multi_payment = namedtuple("bitcoinacceptor_multi_payment", ["status", "payment"])
+
+    def _payment(currency, destination):
+        first_price, second_price = prices.get(currency, (None, None))
+        if currency == "xmr":
+            address, monero_rpc = None, destination
+        else:
+            address, monero_rpc = destination, None
+        return fiat_payment(
+            address,
+            cents,
+            unique,
+            currency,
+            first_price=first_price,
+            second_price=second_price,
+            txids=txids,
+            monero_rpc=monero_rpc,
+            min_confirmations=min_confirmations,
+        )
+
+    start = time.monotonic()
+    executor = ThreadPoolExecutor(max_workers=max(len(destinations), 1))
+    futures = {
+        currency: executor.submit(_payment, currency, destination)
+        for currency, destination in destinations.items()
+    }
+    # Don't wait on stragglers, they'll finish (or time out) on their own.
+    executor.shutdown(wait=False)
+
+    results = {}
+    for currency, future in futures.items():
+        if isinstance(deadline, dict):
+            currency_deadline = deadline.get(currency, GET_TIMEOUT)
+        else:
+            currency_deadline = deadline
+        remaining = max(currency_deadline - (time.monotonic() - start), 0)
+        try:
+            results[currency] = multi_payment("ok", future.result(timeout=remaining))
+        except FutureTimeoutError:
+            results[currency] = multi_payment("pending", None)
+        except Exception:
+            logging.exception(f"Looking up {currency} payment failed.")
+            results[currency] = multi_payment("error", None)
+    return results
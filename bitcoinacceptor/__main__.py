@@ -0,0 +1,62 @@
+"""
+python3 -m bitcoinacceptor serve --help
+"""
+import argparse
+
+from . import service
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(prog="python3 -m bitcoinacceptor")
+    subparsers = parser.add_subparsers(dest="command")
+    serve_parser = subparsers.add_parser(
+        "serve", help="Run the payment status HTTP service."
+    )
+    serve_parser.add_argument("--host", default="127.0.0.1")
+    serve_parser.add_argument("--port", type=int, default=8080)
+    serve_parser.add_argument(
+        "--ttl",
+        type=float,
+        default=service.TTL,
+        help="Seconds to share unspents and rates between invoices.",
+    )
+    serve_parser.add_argument(
+        "--poll-interval", type=float, default=service.POLL_INTERVAL
+    )
+    serve_parser.add_argument("--invoice-ttl", type=int, default=service.INVOICE_TTL)
+    serve_parser.add_argument("--monero-host", help="Monero wallet RPC, for xmr.")
+    serve_parser.add_argument("--monero-port", type=int, default=18088)
+    serve_parser.add_argument("--monero-user", default="")
+    serve_parser.add_argument("--monero-password", default="")
+    serve_parser.add_argument(
+        "--fake",
+        action="store_true",
+        help="Use a simulated chain and fixed rates, for testing.",
+    )
+    args = parser.parse_args(args)
+
+    if args.command != "serve":
+        parser.print_help()
+        return
+
+    monero_rpc = None
+    if args.monero_host is not None:
+        monero_rpc = {
+            "host": args.monero_host,
+            "port": args.monero_port,
+            "user": args.monero_user,
+            "password": args.monero_password,
+        }
+    service.serve(
+        host=args.host,
+        port=args.port,
+        fake=args.fake,
+        monero_rpc=monero_rpc,
+        ttl=args.ttl,
+        poll_interval=args.poll_interval,
+        invoice_ttl=args.invoice_ttl,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""
+Small on-disk cache so a restarted process doesn't hit every upstream cold.
+
+Backed by sqlite. Nothing is opened until the first lookup, and expired rows
+are dropped when the file is opened, which keeps it compact.
+"""
+import json
+import sqlite3
+import threading
+import time
+
+_lock = threading.Lock()
+_connection = None
+_connection_path = None
+
+
+def _connect(path):
+    """
+    Opens (or reuses) the cache database at path.
+
+    Expired entries are purged on open so we never load them.
+    """
+    global _connection, _connection_path
+    if _connection is not None and _connection_path == path:
+        return _connection
+    if _connection is not None:
+        _connection.close()
+    connection = sqlite3.connect(path, check_same_thread=False)
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS cache ("
+        "kind TEXT NOT NULL, "
+        "key TEXT NOT NULL, "
+        "value TEXT NOT NULL, "
+        "expires REAL, "
+        "PRIMARY KEY (kind, key))"
+    )
+    connection.execute(
+        "DELETE FROM cache WHERE expires IS NOT NULL AND expires < ?", (time.time(),)
+    )
+    connection.commit()
+    _connection = connection
+    _connection_path = path
+    return _connection
+
+
+def load(path, kind, key):
+    """
+    Returns the cached value for kind/key, or None if missing or expired.
+
+    path of None means caching is disabled.
+    """
+    if path is None:
+        return None
+    with _lock:
+        connection = _connect(path)
+        row = connection.execute(
+            "SELECT value, expires FROM cache WHERE kind = ? AND key = ?",
+            (kind, key),
+        ).fetchone()
+    if row is None:
+        return None
+    value, expires = row
+    if expires is not None and expires < time.time():
+        return None
+    return json.loads(value)
+
+
+def store(path, kind, key, value, ttl=None):
+    """
+    Stores a JSON serializable value for kind/key.
+
+    ttl is in seconds. None means it never expires.
+    """
+    if path is None:
+        return
+    expires = None
+    if ttl is not None:
+        expires = time.time() + ttl
+    with _lock:
+        connection = _connect(path)
+        connection.execute(
+            "INSERT OR REPLACE INTO cache (kind, key, value, expires) "
+            "VALUES (?, ?, ?, ?)",
+            (kind, key, json.dumps(value), expires),
+        )
+        connection.commit()
+
+
+def store_many(path, kind, items, ttl=None):
+    """
+    Like store(), but for an iterable of (key, value) pairs, all in one
+    transaction.
+    """
+    if path is None:
+        return
+    expires = None
+    if ttl is not None:
+        expires = time.time() + ttl
+    rows = [(kind, key, json.dumps(value), expires) for key, value in items]
+    with _lock:
+        connection = _connect(path)
+        with connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO cache (kind, key, value, expires) "
+                "VALUES (?, ?, ?, ?)",
+                rows,
+            )
+
+
+def close():
+    """
+    Closes the cache database, if open.
+    """
+    global _connection, _connection_path
+    with _lock:
+        if _connection is not None:
+            _connection.close()
+        _connection = None
+        _connection_path = None
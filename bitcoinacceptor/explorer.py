@@ -0,0 +1,158 @@
+"""
+Lean unspent lookups against Esplora style explorers (blockstream.info,
+mempool.space or your own).
+
+Busy addresses can have a lot of unspents and we only care about amount,
+txid and confirmations. So the response is parsed as it streams in, kept
+in arrays instead of objects, anything out of the confirmation range is
+dropped on the way and we stop reading once we find what we want.
+"""
+import codecs
+import itertools
+import json
+from array import array
+
+from . import transport
+
+CHUNK_SIZE = 65536
+# After stopping early, read up to this many more bytes so the connection
+# can go back to the pool. Past that, dropping it and paying for a new
+# handshake next time is cheaper.
+DRAIN_LIMIT = 262144
+
+
+class CompactUnspents:
+    """
+    Unspents as parallel arrays of amount, txid and confirmations.
+
+    Iterates as (amount, txid, confirmations) tuples.
+    """
+
+    __slots__ = ("amounts", "txids", "confirmations")
+
+    def __init__(self):
+        self.amounts = array("q")
+        # 32 bytes per txid, back to back.
+        self.txids = bytearray()
+        self.confirmations = array("l")
+
+    def append(self, amount, txid, confirmations):
+        self.amounts.append(amount)
+        self.txids += bytes.fromhex(txid)
+        self.confirmations.append(confirmations)
+
+    def __len__(self):
+        return len(self.amounts)
+
+    def __iter__(self):
+        for index, amount in enumerate(self.amounts):
+            start = index * 32
+            end = start + 32
+            txid = self.txids[start:end].hex()
+            yield (amount, txid, self.confirmations[index])
+
+
+def iter_json_array(chunks):
+    """
+    Yields elements of a JSON array as they show up in chunks of bytes.
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    position = 0
+    started = False
+    # None marks the end of the input.
+    for chunk in itertools.chain(chunks, [None]):
+        final = chunk is None
+        if final:
+            text = text_decoder.decode(b"", final=True)
+        else:
+            text = text_decoder.decode(chunk)
+        buffer = buffer[position:] + text
+        position = 0
+        while True:
+            while position < len(buffer) and buffer[position] in " \t\r\n,":
+                position += 1
+            if position == len(buffer):
+                break
+            if started is False:
+                if buffer[position] != "[":
+                    raise ValueError("Expected a JSON array.")
+                started = True
+                position += 1
+                continue
+            if buffer[position] == "]":
+                return
+            try:
+                element, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                # Probably cut off mid element, wait for more.
+                break
+            if end == len(buffer) and not final:
+                # A number or literal might carry on in the next chunk.
+                break
+            position = end
+            yield element
+    raise ValueError("JSON array was cut off or malformed.")
+
+
+def _drain(chunks, limit):
+    """
+    Reads the rest of chunks, giving up past limit bytes. Returns True if
+    it got to the end.
+    """
+    drained = 0
+    for chunk in chunks:
+        drained += len(chunk)
+        if drained > limit:
+            return False
+    return True
+
+
+def _tip_height(endpoint):
+    request = transport.get(endpoint + "blocks/tip/height")
+    request.raise_for_status()
+    return int(request.text)
+
+
+def fetch_unspents(
+    endpoint,
+    address,
+    min_confirmations=0,
+    max_confirmations=None,
+    wanted=(),
+    txids=(),
+):
+    """
+    Returns CompactUnspents for address from the Esplora API at endpoint,
+    like https://blockstream.info/api/
+
+    Only unspents with min_confirmations to max_confirmations are kept.
+    If wanted (amounts) is given, stops at the first unspent with one of
+    those amounts that isn't in txids, so only use it if you're after a
+    single match.
+
+    Stopping early still reads the rest of the response if it's under
+    DRAIN_LIMIT bytes, so the keep-alive connection gets reused. Bigger
+    responses are cut off and the connection is dropped.
+    """
+    tip_height = _tip_height(endpoint)
+    unspents = CompactUnspents()
+    url = f"{endpoint}address/{address}/utxo"
+    with transport.get(url, stream=True) as request:
+        request.raise_for_status()
+        chunks = request.iter_content(chunk_size=CHUNK_SIZE)
+        for utxo in iter_json_array(chunks):
+            if utxo["status"]["confirmed"]:
+                confirmations = tip_height - utxo["status"]["block_height"] + 1
+            else:
+                confirmations = 0
+            if confirmations < min_confirmations:
+                continue
+            if max_confirmations is not None and confirmations > max_confirmations:
+                continue
+            unspents.append(utxo["value"], utxo["txid"], confirmations)
+            if utxo["value"] in wanted and utxo["txid"] not in txids:
+                _drain(chunks, DRAIN_LIMIT)
+                break
+    return unspents
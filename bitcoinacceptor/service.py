@@ -0,0 +1,511 @@
+"""
+Standalone payment status service.
+
+python3 -m bitcoinacceptor serve --help
+
+Hosts fiat_payment() behind a small HTTP API so several applications can
+share one set of polling loops. Every invoice on an address shares one
+upstream lookup per ttl seconds, however many clients are asking.
+
+POST /quotes            {"currency", "address", "cents", "unique"} and
+                        optionally "price" and "min_confirmations".
+                        Leave out address for xmr.
+GET  /invoices/<unique>
+POST /invoices/check    {"uniques": [...]}
+GET  /events            Server-sent events, one per invoice status change.
+                        Clients more than MAX_QUEUED_EVENTS behind get
+                        disconnected.
+
+Invoice status is "unpaid", "paid" or "expired". Past INVOICE_TTL, an
+invoice only expires once a lookup finds no payment for it, not even an
+unconfirmed one. Invoices are only kept in memory, so clients should hang
+on to txids themselves too.
+
+With --fake, there's a simulated chain and fixed rates instead of the real
+thing, plus POST /fake/pay {"address", "satoshis"} and POST /fake/mine.
+"""
+import asyncio
+import functools
+import json
+import logging
+import threading
+import time
+from urllib.parse import unquote
+
+import bitcoinacceptor
+from .simulator import SimulatedChain
+
+POLL_INTERVAL = 5
+# Seconds to share unspents and rates between invoices.
+TTL = 5
+INVOICE_TTL = 3600
+# Seconds to remember accepted txids. Unspents past MAX_CONFIRMATIONS never
+# match again, so 100 ten minute blocks leaves plenty of room for slow ones.
+TXID_TTL = 100 * 600
+MAX_BODY = 65536
+# Server-sent events comment to keep idle connections open.
+KEEPALIVE = 15
+# Events an /events client can fall behind by before it gets disconnected.
+MAX_QUEUED_EVENTS = 100
+
+FAKE_RATES = {"btc": 30000.0, "bch": 300.0, "bsv": 50.0, "xmr": 150.0}
+
+STATUS_MESSAGES = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    413: "Payload Too Large",
+    502: "Bad Gateway",
+}
+
+
+class SharedUnspents:
+    """
+    Use as bitcoinacceptor.UNSPENTS_BACKEND so every lookup for an address
+    within ttl seconds shares one upstream fetch. Concurrent lookups wait on
+    the fetch that's already running instead of starting their own.
+    """
+
+    def __init__(self, fetch, ttl=TTL):
+        self.fetch = fetch
+        self.ttl = ttl
+        self.upstream_calls = 0
+        self._lock = threading.Lock()
+        # (currency, address): (fetched at, unspents)
+        self._fetched = {}
+        # (currency, address): threading.Event
+        self._in_flight = {}
+
+    def __call__(self, address, currency):
+        key = (currency, address)
+        while True:
+            with self._lock:
+                fetched = self._fetched.get(key)
+                if fetched is not None and time.monotonic() - fetched[0] < self.ttl:
+                    return fetched[1]
+                event = self._in_flight.get(key)
+                if event is None:
+                    event = threading.Event()
+                    self._in_flight[key] = event
+                    break
+            event.wait()
+        try:
+            unspents = list(self.fetch(address, currency))
+            with self._lock:
+                self.upstream_calls += 1
+                now = time.monotonic()
+                # Forget addresses nobody has asked about lately.
+                self._fetched = {
+                    other_key: fetched
+                    for other_key, fetched in self._fetched.items()
+                    if now - fetched[0] < self.ttl
+                }
+                self._fetched[key] = (now, unspents)
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+            event.set()
+        return unspents
+
+
+class PaymentService:
+    """
+    Keeps track of invoices and answers HTTP requests about them.
+
+    backend is a callable(address, currency) for unspents, like a
+    SimulatedChain. Defaults to the real explorers. rates is a
+    callable(currency) that defaults to fiat_per_coin().
+    """
+
+    def __init__(
+        self,
+        backend=None,
+        rates=None,
+        monero_rpc=None,
+        ttl=TTL,
+        poll_interval=POLL_INTERVAL,
+        invoice_ttl=INVOICE_TTL,
+        txid_ttl=TXID_TTL,
+    ):
+        if backend is None:
+            backend = bitcoinacceptor._upstream_unspents
+        if rates is None:
+            rates = bitcoinacceptor.fiat_per_coin
+        self.backend = backend
+        self.unspents = SharedUnspents(backend, ttl)
+        self.rates = rates
+        self.monero_rpc = monero_rpc
+        self.ttl = ttl
+        self.poll_interval = poll_interval
+        self.invoice_ttl = invoice_ttl
+        self.txid_ttl = txid_ttl
+        # unique: invoice dict
+        self.invoices = {}
+        # txid: accepted at
+        self.accepted_txids = {}
+        self._rates = {}
+        # currency: asyncio.Task, so concurrent lookups share one.
+        self._rate_tasks = {}
+        self._subscribers = set()
+        self._server = None
+        self._watcher = None
+        self._old_backend = None
+
+    async def _run(self, function, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None, functools.partial(function, *args, **kwargs)
+        )
+
+    async def _rate(self, currency):
+        cached = self._rates.get(currency)
+        if cached is not None and time.monotonic() - cached[0] < self.ttl:
+            return cached[1]
+        task = self._rate_tasks.get(currency)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch_rate(currency))
+            self._rate_tasks[currency] = task
+        # One caller going away shouldn't cancel it for everybody else.
+        return await asyncio.shield(task)
+
+    async def _fetch_rate(self, currency):
+        try:
+            rate = await self._run(self.rates, currency)
+            self._rates[currency] = (time.monotonic(), rate)
+            return rate
+        finally:
+            del self._rate_tasks[currency]
+
+    def _public(self, invoice):
+        return {
+            key: invoice[key]
+            for key in (
+                "unique",
+                "currency",
+                "address",
+                "cents",
+                "satoshis",
+                "uri",
+                "final_price",
+                "status",
+                "txid",
+            )
+        }
+
+    def _publish(self, invoice):
+        for queue in list(self._subscribers):
+            try:
+                queue.put_nowait(self._public(invoice))
+            except asyncio.QueueFull:
+                # Too slow, _events() hangs up on it.
+                self._subscribers.discard(queue)
+
+    async def _payment(self, invoice, first_price, min_confirmations=None):
+        if min_confirmations is None:
+            min_confirmations = invoice["min_confirmations"]
+        if invoice["currency"] == "xmr":
+            monero_rpc = self.monero_rpc
+        else:
+            monero_rpc = None
+        return await self._run(
+            bitcoinacceptor.fiat_payment,
+            invoice["address"],
+            invoice["cents"],
+            invoice["unique"],
+            invoice["currency"],
+            first_price=first_price,
+            second_price=invoice["price"],
+            txids=self.accepted_txids,
+            monero_rpc=monero_rpc,
+            min_confirmations=min_confirmations,
+        )
+
+    def _settle(self, invoice, payment):
+        # Another check of this invoice may have settled it, or another
+        # invoice claimed the txid, while we were looking.
+        if invoice["status"] != "unpaid":
+            return
+        if payment.txid is False or payment.txid in self.accepted_txids:
+            return
+        self.accepted_txids[payment.txid] = time.monotonic()
+        invoice["txid"] = payment.txid
+        invoice["status"] = "paid"
+        self._publish(invoice)
+
+    async def quote(
+        self,
+        currency,
+        address,
+        cents,
+        unique,
+        price=None,
+        min_confirmations=bitcoinacceptor.MIN_CONFIRMATIONS,
+    ):
+        """
+        Makes an invoice, or returns the existing one for unique.
+        """
+        if unique in self.invoices:
+            return self._public(self.invoices[unique])
+        bitcoinacceptor.validate_currency(currency)
+        if currency == "xmr":
+            if self.monero_rpc is None:
+                raise ValueError("This service has no Monero wallet.")
+            address = None
+        elif not isinstance(address, str) or address == "":
+            raise ValueError("address is required.")
+        if not isinstance(unique, str) or unique == "":
+            raise ValueError("unique is required.")
+        if not isinstance(cents, int) or cents < 1:
+            raise ValueError("cents must be a positive integer.")
+        fixed_price = price is not None
+        if price is None:
+            price = await self._rate(currency)
+        invoice = {
+            "unique": unique,
+            "currency": currency,
+            "address": address,
+            "cents": cents,
+            "price": price,
+            "fixed_price": fixed_price,
+            "min_confirmations": min_confirmations,
+            "created": time.monotonic(),
+            "status": "unpaid",
+            "txid": None,
+        }
+        payment = await self._payment(invoice, price)
+        invoice["satoshis"] = payment.satoshis
+        invoice["uri"] = payment.uri
+        invoice["final_price"] = payment.final_price
+        self.invoices[unique] = invoice
+        self._settle(invoice, payment)
+        return self._public(invoice)
+
+    async def check(self, unique):
+        """
+        Returns the invoice for unique, checking for payment if it's still
+        unpaid. None if there's no such invoice.
+
+        Past invoice_ttl it gets one more lookup before expiring, and stays
+        unpaid while an unconfirmed payment for it is waiting.
+        """
+        invoice = self.invoices.get(unique)
+        if invoice is None:
+            return None
+        if invoice["status"] != "unpaid":
+            return self._public(invoice)
+        if invoice["fixed_price"]:
+            first_price = invoice["price"]
+        else:
+            first_price = await self._rate(invoice["currency"])
+        payment = await self._payment(invoice, first_price)
+        self._settle(invoice, payment)
+        if invoice["status"] != "unpaid":
+            return self._public(invoice)
+        if time.monotonic() - invoice["created"] > self.invoice_ttl:
+            waiting = False
+            if invoice["min_confirmations"] > 0:
+                # Paid in time but not confirmed yet? Keep waiting on it.
+                unconfirmed = await self._payment(invoice, first_price, 0)
+                waiting = unconfirmed.txid is not False
+            if not waiting and invoice["status"] == "unpaid":
+                invoice["status"] = "expired"
+                self._publish(invoice)
+        return self._public(invoice)
+
+    async def check_many(self, uniques):
+        """
+        Checks several invoices at once. Returns a dict of unique to invoice
+        (or None).
+        """
+        invoices = await asyncio.gather(*[self.check(unique) for unique in uniques])
+        return dict(zip(uniques, invoices))
+
+    def _prune(self):
+        """
+        Forgets invoices twice as old as invoice_ttl and txids accepted more
+        than txid_ttl ago.
+        """
+        now = time.monotonic()
+        for unique, invoice in list(self.invoices.items()):
+            if now - invoice["created"] > self.invoice_ttl * 2:
+                del self.invoices[unique]
+        for txid, accepted in list(self.accepted_txids.items()):
+            if now - accepted > self.txid_ttl:
+                del self.accepted_txids[txid]
+
+    async def watch(self):
+        """
+        Checks every unpaid invoice every poll_interval seconds so events go
+        out even if nobody is polling. Old invoices and txids are pruned as
+        it goes.
+        """
+        while True:
+            self._prune()
+            uniques = [
+                unique
+                for unique, invoice in self.invoices.items()
+                if invoice["status"] == "unpaid"
+            ]
+            results = await asyncio.gather(
+                *[self.check(unique) for unique in uniques], return_exceptions=True
+            )
+            for unique, result in zip(uniques, results):
+                if isinstance(result, Exception):
+                    logging.error(f"Checking invoice {unique} failed: {result!r}")
+            await asyncio.sleep(self.poll_interval)
+
+    async def _route(self, method, path, body):
+        """
+        Returns (HTTP status, JSON serializable response).
+        """
+        if method == "POST" and path == "/quotes":
+            params = json.loads(body)
+            invoice = await self.quote(
+                currency=params["currency"],
+                address=params.get("address"),
+                cents=params["cents"],
+                unique=params["unique"],
+                price=params.get("price"),
+                min_confirmations=params.get(
+                    "min_confirmations", bitcoinacceptor.MIN_CONFIRMATIONS
+                ),
+            )
+            return 200, invoice
+        if method == "GET" and path.startswith("/invoices/"):
+            invoice = await self.check(unquote(path.split("/", 2)[2]))
+            if invoice is None:
+                return 404, {"error": "No such invoice."}
+            return 200, invoice
+        if method == "POST" and path == "/invoices/check":
+            uniques = json.loads(body)["uniques"]
+            if not isinstance(uniques, list):
+                raise ValueError("uniques must be a list.")
+            return 200, {"invoices": await self.check_many(uniques)}
+        if isinstance(self.backend, SimulatedChain):
+            if method == "POST" and path == "/fake/pay":
+                params = json.loads(body)
+                txid = self.backend.pay(params["address"], params["satoshis"])
+                return 200, {"txid": txid}
+            if method == "POST" and path == "/fake/mine":
+                self.backend.mine()
+                return 200, {"height": self.backend.height}
+        return 404, {"error": "Not found."}
+
+    def _respond(self, writer, status, response):
+        body = bytes(json.dumps(response), "utf-8")
+        head = (
+            f"HTTP/1.1 {status} {STATUS_MESSAGES[status]}\r\n"
+            "Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: close\r\n\r\n"
+        )
+        writer.write(bytes(head, "latin-1") + body)
+
+    async def _events(self, writer):
+        writer.write(
+            b"HTTP/1.1 200 OK\r\n"
+            b"Content-Type: text/event-stream\r\n"
+            b"Cache-Control: no-cache\r\n"
+            b"Connection: close\r\n\r\n"
+        )
+        await writer.drain()
+        queue = asyncio.Queue(MAX_QUEUED_EVENTS)
+        self._subscribers.add(queue)
+        try:
+            while True:
+                try:
+                    invoice = await asyncio.wait_for(queue.get(), KEEPALIVE)
+                except asyncio.TimeoutError:
+                    writer.write(b": keepalive\n\n")
+                else:
+                    if queue not in self._subscribers:
+                        # Fell too far behind, let it reconnect and catch up.
+                        break
+                    writer.write(bytes(f"data: {json.dumps(invoice)}\n\n", "utf-8"))
+                await writer.drain()
+        finally:
+            self._subscribers.discard(queue)
+
+    async def handle(self, reader, writer):
+        """
+        asyncio.start_server() callback. One request per connection.
+        """
+        try:
+            request_line = await reader.readline()
+            method, target, _ = request_line.decode("latin-1").split(" ", 2)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+            length = int(headers.get("content-length", 0))
+            if length > MAX_BODY:
+                self._respond(writer, 413, {"error": "Request body too large."})
+                return
+            body = await reader.readexactly(length)
+            path = target.split("?", 1)[0]
+            if method == "GET" and path == "/events":
+                await self._events(writer)
+                return
+            try:
+                status, response = await self._route(method, path, body)
+            except KeyError as e:
+                status, response = 400, {"error": f"{e} is required."}
+            except (ValueError, TypeError) as e:
+                status, response = 400, {"error": str(e)}
+            except Exception:
+                logging.exception(f"{method} {path} failed.")
+                status, response = 502, {"error": "Upstream lookup failed."}
+            self._respond(writer, status, response)
+            await writer.drain()
+        except (ValueError, ConnectionError, asyncio.IncompleteReadError):
+            # Malformed request or the client went away.
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host="127.0.0.1", port=8080):
+        """
+        Starts listening and watching invoices. Returns the asyncio server.
+
+        Points bitcoinacceptor.UNSPENTS_BACKEND at our shared lookups until
+        stop().
+        """
+        self._old_backend = bitcoinacceptor.UNSPENTS_BACKEND
+        bitcoinacceptor.UNSPENTS_BACKEND = self.unspents
+        self._server = await asyncio.start_server(self.handle, host, port)
+        self._watcher = asyncio.ensure_future(self.watch())
+        return self._server
+
+    async def stop(self):
+        self._watcher.cancel()
+        self._server.close()
+        await self._server.wait_closed()
+        bitcoinacceptor.UNSPENTS_BACKEND = self._old_backend
+
+
+def serve(host="127.0.0.1", port=8080, fake=False, **kwargs):
+    """
+    Runs a PaymentService until interrupted. kwargs go to PaymentService.
+
+    fake uses a SimulatedChain and FAKE_RATES instead of the real thing.
+    """
+    if fake:
+        kwargs["backend"] = SimulatedChain()
+        kwargs["rates"] = FAKE_RATES.get
+    service = PaymentService(**kwargs)
+
+    async def _serve():
+        server = await service.start(host, port)
+        logging.info(f"Listening on {host}:{port}")
+        try:
+            await server.serve_forever()
+        finally:
+            await service.stop()
+
+    try:
+        asyncio.run(_serve())
+    except KeyboardInterrupt:
+        pass
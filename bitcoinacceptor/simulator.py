@@ -0,0 +1,303 @@
+"""
+Load simulator for the single address scheme.
+
+Drives fiat_payment() against a fake chain on a simulated clock, so you can
+check how many invoices your prices and traffic can take before payments
+get mixed up, and pick address counts and poll intervals to match.
+
+python3 -m bitcoinacceptor.simulator --help
+"""
+import argparse
+import random
+import time
+from collections import namedtuple
+
+import bitcoinacceptor
+
+simulation_report = namedtuple(
+    "simulation_report",
+    [
+        "invoices",
+        "paid",
+        "accepted",
+        "wrong",
+        "ambiguous",
+        "missed",
+        "upstream_calls",
+        "calls_per_accepted",
+        "latency",
+        "call_ms",
+    ],
+)
+
+
+class SimulatedChain:
+    """
+    Fake chain to use as bitcoinacceptor.UNSPENTS_BACKEND.
+
+    Unspents past MAX_CONFIRMATIONS are pruned as blocks are mined since
+    they can never match anyway.
+    """
+
+    def __init__(self):
+        self.height = 0
+        self.calls = 0
+        self._tx_count = 0
+        # address: [[amount, txid, height or None], ...]
+        self._unspents = {}
+
+    def pay(self, address, satoshis):
+        self._tx_count += 1
+        txid = f"simtx{self._tx_count}"
+        self._unspents.setdefault(address, []).append([satoshis, txid, None])
+        return txid
+
+    def mine(self):
+        self.height += 1
+        for address, unspents in self._unspents.items():
+            for unspent in unspents:
+                if unspent[2] is None:
+                    unspent[2] = self.height
+            self._unspents[address] = [
+                unspent
+                for unspent in unspents
+                if self._confirmations(unspent[2]) <= bitcoinacceptor.MAX_CONFIRMATIONS
+            ]
+
+    def _confirmations(self, height):
+        if height is None:
+            return 0
+        return self.height - height + 1
+
+    def __call__(self, address, currency):
+        self.calls += 1
+        return [
+            [amount, txid, self._confirmations(height)]
+            for amount, txid, height in self._unspents.get(address, [])
+        ]
+
+
+def _percentiles(values, percents=(50, 90, 99)):
+    """
+    Nearest rank percentiles. Empty if there's nothing to go on.
+    """
+    if len(values) == 0:
+        return {}
+    values = sorted(values)
+    result = {}
+    for percent in percents:
+        rank = max(int(round(percent / 100 * len(values))), 1)
+        result[percent] = values[rank - 1]
+    return result
+
+
+def simulate(
+    address="16jCrzcXo2PxadrQiQwUgwrmEwDGQYBwZq",
+    currency="btc",
+    duration=600,
+    invoice_rate=0.5,
+    cents=(500, 1000, 2000, 5000),
+    fiat_price=30000.0,
+    volatility=0.002,
+    price_interval=60,
+    pay_probability=0.9,
+    pay_delay=(10, 120),
+    poll_interval=5,
+    invoice_ttl=3600,
+    block_interval=600,
+    min_confirmations=bitcoinacceptor.MIN_CONFIRMATIONS,
+    seed=None,
+):
+    """
+    Runs one simulation and returns a simulation_report.
+
+    Every second of simulated time, invoices arrive at invoice_rate per
+    second priced at a random choice from cents. Customers pay what they
+    were quoted pay_delay seconds later (with pay_probability) and poll
+    every poll_interval seconds until accepted or invoice_ttl runs out.
+    The fiat price does a random walk every price_interval seconds and
+    polls pass the current price as first_price and the quoted price as
+    second_price. Blocks arrive every block_interval seconds on average.
+
+    wrong is acceptances of somebody else's payment (or no payment at all),
+    ambiguous is payments whose amount matched more than one open invoice
+    when sent (at the current price or that invoice's quoted one) and missed
+    is payments never accepted for their own invoice.
+    latency is seconds from payment to acceptance and call_ms is wall
+    clock milliseconds per fiat_payment() call, both as percentiles.
+    """
+    bitcoinacceptor.validate_currency(currency)
+    if currency == "xmr":
+        raise ValueError("The simulator is only for btc, bch, and bsv.")
+    rng = random.Random(seed)
+    chain = SimulatedChain()
+    accepted_txids = []
+    # txid: invoice number
+    txid_invoices = {}
+    # invoice number: dict
+    open_invoices = {}
+    invoice_count = 0
+    paid = 0
+    accepted = 0
+    wrong = 0
+    ambiguous = 0
+    latencies = []
+    call_times = []
+    price = fiat_price
+    next_invoice = rng.expovariate(invoice_rate)
+
+    def poll(invoice_number, invoice):
+        start = time.perf_counter()
+        payment = bitcoinacceptor.fiat_payment(
+            address,
+            invoice["cents"],
+            f"invoice{invoice_number}",
+            currency,
+            first_price=price,
+            second_price=invoice["price"],
+            txids=accepted_txids,
+            min_confirmations=min_confirmations,
+        )
+        call_times.append((time.perf_counter() - start) * 1000)
+        return payment
+
+    def accepted_amounts(invoice):
+        """
+        Amounts a poll for invoice would take right now, at the current
+        price or the quoted one.
+        """
+        satoshis_to_try, _ = bitcoinacceptor._fiat_satoshis_to_try(
+            currency, invoice["cents"], price, invoice["price"]
+        )
+        return {satoshis + invoice["security_code"] for satoshis in satoshis_to_try}
+
+    old_backend = bitcoinacceptor.UNSPENTS_BACKEND
+    old_cache_path = bitcoinacceptor.CACHE_PATH
+    bitcoinacceptor.UNSPENTS_BACKEND = chain
+    # Cache TTLs run on the real clock, which would skew everything.
+    bitcoinacceptor.CACHE_PATH = None
+    try:
+        second = 0
+        while second < duration or len(open_invoices) > 0:
+            if second > 0 and second % price_interval == 0:
+                price = price * (1 + rng.gauss(0, volatility))
+
+            while second < duration and next_invoice <= second:
+                next_invoice += rng.expovariate(invoice_rate)
+                invoice_count += 1
+                invoice = {
+                    "cents": rng.choice(cents),
+                    "price": price,
+                    "created": second,
+                    "pay_at": None,
+                    "paid_at": None,
+                    "txid": None,
+                }
+                quote = poll(invoice_count, invoice)
+                invoice["satoshis"] = quote.satoshis
+                invoice["security_code"] = bitcoinacceptor._satoshi_security_code(
+                    f"invoice{invoice_count}"
+                )
+                if rng.random() < pay_probability:
+                    invoice["pay_at"] = second + rng.randint(*pay_delay)
+                open_invoices[invoice_count] = invoice
+
+            for invoice_number, invoice in open_invoices.items():
+                if invoice["pay_at"] == second:
+                    matches = [
+                        other
+                        for other in open_invoices.values()
+                        if invoice["satoshis"] in accepted_amounts(other)
+                    ]
+                    if len(matches) > 1:
+                        ambiguous += 1
+                    invoice["txid"] = chain.pay(address, invoice["satoshis"])
+                    invoice["paid_at"] = second
+                    txid_invoices[invoice["txid"]] = invoice_number
+                    paid += 1
+
+            if rng.random() < 1 / block_interval:
+                chain.mine()
+
+            for invoice_number, invoice in list(open_invoices.items()):
+                age = second - invoice["created"]
+                if age > 0 and age % poll_interval == 0:
+                    payment = poll(invoice_number, invoice)
+                    if payment.txid is not False:
+                        accepted_txids.append(payment.txid)
+                        del open_invoices[invoice_number]
+                        if txid_invoices.get(payment.txid) == invoice_number:
+                            accepted += 1
+                            latencies.append(second - invoice["paid_at"])
+                        else:
+                            wrong += 1
+                        continue
+                if age >= invoice_ttl:
+                    del open_invoices[invoice_number]
+            second += 1
+    finally:
+        bitcoinacceptor.UNSPENTS_BACKEND = old_backend
+        bitcoinacceptor.CACHE_PATH = old_cache_path
+
+    calls_per_accepted = None
+    if accepted > 0:
+        calls_per_accepted = chain.calls / accepted
+    return simulation_report(
+        invoices=invoice_count,
+        paid=paid,
+        accepted=accepted,
+        wrong=wrong,
+        ambiguous=ambiguous,
+        missed=paid - accepted,
+        upstream_calls=chain.calls,
+        calls_per_accepted=calls_per_accepted,
+        latency=_percentiles(latencies),
+        call_ms=_percentiles(call_times),
+    )
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        prog="python3 -m bitcoinacceptor.simulator",
+        description="Simulate load on the single address acceptance scheme.",
+    )
+    parser.add_argument("--currency", default="btc", choices=("btc", "bch", "bsv"))
+    parser.add_argument("--duration", type=int, default=600)
+    parser.add_argument("--invoice-rate", type=float, default=0.5)
+    parser.add_argument("--cents", type=int, nargs="+", default=[500, 1000, 2000, 5000])
+    parser.add_argument("--fiat-price", type=float, default=30000.0)
+    parser.add_argument("--volatility", type=float, default=0.002)
+    parser.add_argument("--price-interval", type=int, default=60)
+    parser.add_argument("--pay-probability", type=float, default=0.9)
+    parser.add_argument("--pay-delay", type=int, nargs=2, default=[10, 120])
+    parser.add_argument("--poll-interval", type=int, default=5)
+    parser.add_argument("--invoice-ttl", type=int, default=3600)
+    parser.add_argument("--block-interval", type=int, default=600)
+    parser.add_argument(
+        "--min-confirmations", type=int, default=bitcoinacceptor.MIN_CONFIRMATIONS
+    )
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args(args)
+
+    report = simulate(
+        currency=args.currency,
+        duration=args.duration,
+        invoice_rate=args.invoice_rate,
+        cents=args.cents,
+        fiat_price=args.fiat_price,
+        volatility=args.volatility,
+        price_interval=args.price_interval,
+        pay_probability=args.pay_probability,
+        pay_delay=args.pay_delay,
+        poll_interval=args.poll_interval,
+        invoice_ttl=args.invoice_ttl,
+        block_interval=args.block_interval,
+        min_confirmations=args.min_confirmations,
+        seed=args.seed,
+    )
+    for field, value in report._asdict().items():
+        print(f"{field}: {value}")
+
+
+if __name__ == "__main__":
+    main()
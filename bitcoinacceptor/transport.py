@@ -0,0 +1,139 @@
+"""
+One pooled HTTP session for every upstream call: rates, explorers and the
+Monero wallet RPC.
+
+Connections are kept alive per host, so polling doesn't pay for a new TCP
+and TLS handshake every time.
+"""
+import sys
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# How many hosts to keep connection pools for.
+POOL_CONNECTIONS = 10
+# How many connections to keep per host.
+POOL_MAXSIZE = 10
+# Seconds, unless the caller passes its own.
+TIMEOUT = 30
+# Like socks5h://127.0.0.1:9050 for Tor. Applies to everything, including
+# .onion Monero wallets. Needs requests[socks].
+SOCKS_PROXY = None
+
+_lock = threading.Lock()
+_session = None
+
+
+def _new_session():
+    new_session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE)
+    new_session.mount("http://", adapter)
+    new_session.mount("https://", adapter)
+    if SOCKS_PROXY is not None:
+        new_session.proxies = {"http": SOCKS_PROXY, "https": SOCKS_PROXY}
+    return new_session
+
+
+def session():
+    """
+    Returns the shared requests.Session, making it if needed.
+    """
+    global _session
+    with _lock:
+        if _session is None:
+            _session = _new_session()
+        return _session
+
+
+def configure(pool_connections=None, pool_maxsize=None, timeout=None, socks_proxy=None):
+    """
+    Changes transport settings. Anything left as None stays the same.
+
+    Pass socks_proxy=False to stop using a proxy.
+    """
+    global POOL_CONNECTIONS, POOL_MAXSIZE, TIMEOUT, SOCKS_PROXY, _session
+    with _lock:
+        if pool_connections is not None:
+            POOL_CONNECTIONS = pool_connections
+        if pool_maxsize is not None:
+            POOL_MAXSIZE = pool_maxsize
+        if timeout is not None:
+            TIMEOUT = timeout
+        if socks_proxy is False:
+            SOCKS_PROXY = None
+        elif socks_proxy is not None:
+            SOCKS_PROXY = socks_proxy
+        if _session is not None:
+            _session.close()
+        _session = None
+
+
+def proxies():
+    """
+    Returns the proxies for a single request.
+
+    Passed with every request since HTTP_PROXY and friends from the
+    environment would win over the session's.
+    """
+    if SOCKS_PROXY is None:
+        return {}
+    return {"http": SOCKS_PROXY, "https": SOCKS_PROXY}
+
+
+def get(url, **kwargs):
+    kwargs.setdefault("timeout", TIMEOUT)
+    kwargs.setdefault("proxies", proxies())
+    return session().get(url, **kwargs)
+
+
+def post(url, **kwargs):
+    kwargs.setdefault("timeout", TIMEOUT)
+    kwargs.setdefault("proxies", proxies())
+    return session().post(url, **kwargs)
+
+
+class _PooledRequests:
+    """
+    Stands in for the requests module inside bit, bitcash and bitsv so their
+    get() and post() calls use the shared session. Everything else is the
+    real requests module.
+
+    Their own per call timeouts still apply. TIMEOUT only kicks in for calls
+    that would otherwise wait forever.
+    """
+
+    def get(self, url, **kwargs):
+        return get(url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return post(url, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(requests, name)
+
+
+class _PooledSession(_PooledRequests):
+    """
+    Same thing for module level requests.Session objects, like bitcash's.
+    Everything else is the current shared session.
+    """
+
+    def __getattr__(self, name):
+        return getattr(session(), name)
+
+
+def install(packages=("bit", "bitcash", "bitsv", "whatsonchain")):
+    """
+    Points the already imported network modules of packages at the shared
+    session. whatsonchain is what bitsv uses under the hood.
+    """
+    pooled_requests = _PooledRequests()
+    pooled_session = _PooledSession()
+    for name, module in list(sys.modules.items()):
+        if name.split(".")[0] not in packages:
+            continue
+        if getattr(module, "requests", None) is requests:
+            module.requests = pooled_requests
+        if isinstance(getattr(module, "session", None), requests.Session):
+            module.session = pooled_session
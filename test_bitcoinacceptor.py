@@ -1,7 +1,18 @@
+import asyncio
+import json
+import threading
+from time import monotonic, sleep
+
 from mock import patch
 
+import bit
+import bitcash
+import bitsv
 import bitcoinacceptor
 import pytest
+import requests
+import whatsonchain.api
+from bitcoinacceptor import explorer, service, simulator, transport
 from bit.network.meta import Unspent
 
 # These are a bit of a mess, not consistent through all currencies. Should be redone.
@@ -14,6 +25,11 @@ monero_rpc = {
     "password": "demopassword",
 }
 
+# Keys from Seed("1" * 64), mainnet.
+MONERO_ADDRESS = "46gXNFZinyUY2Zk5wJNro1L8GMSDCdCiF6rCZ3JKr3VJheaRvUyBHqtLDrC6jY6TLzHHux42kSzgiiXhcuDuceP28Y2x8vA"  # noqa: E501
+MONERO_VIEW_KEY = "779e4dd2c49ac3c0b2edcd1b843c795b7d6eb51457125bb9c90339b752f23700"
+MONERO_SUBADDRESS_190 = "83jx69LG4b6czunbVkX5LYQV36REuc86fCcSH5jAyPsrGPdQ2Z7aaLThqKNi22mJmN4DF2izegsjWWa6bvrGxfTDN1AGPhX"  # noqa: E501
+
 MONERO_URI = "monero:Bec1iqCvhkEEm4EsnztUyo71gApFLpDyD44vHg1GHg8DHAEyeAVkDhV5StqRw8FCL5RrFwoDbntgT6wUgX4etYrMA8Bm7Ey?tx_amount={}"  # noqa: E501
 
 
@@ -45,6 +61,35 @@ def test_monero_security_code():
     codes = bitcoinacceptor._monero_security_code("foo2")
     assert codes[0] == 0
     assert codes[1] == 143
+    # Bigger lookahead uses more of the hash.
+    codes = bitcoinacceptor._monero_security_code("foo", 100000)
+    assert codes[0] == 0
+    assert codes[1] == 98069
+    with pytest.raises(ValueError):
+        bitcoinacceptor._monero_security_code("foo", 0)
+
+
+def test_monero_subaddress():
+    subaddress = bitcoinacceptor._monero_subaddress(
+        0, 190, MONERO_ADDRESS, MONERO_VIEW_KEY
+    )
+    assert subaddress == MONERO_SUBADDRESS_190
+
+
+def test_precompute_monero_subaddresses(tmp_path, monkeypatch):
+    wallet = {"address": MONERO_ADDRESS, "view_key": MONERO_VIEW_KEY}
+    with pytest.raises(ValueError):
+        bitcoinacceptor.precompute_monero_subaddresses(wallet)
+    monkeypatch.setattr(bitcoinacceptor, "CACHE_PATH", str(tmp_path / "cache.sqlite"))
+    assert bitcoinacceptor.precompute_monero_subaddresses(wallet) == 199
+    assert bitcoinacceptor.monero_subaddress_index(MONERO_SUBADDRESS_190) == (0, 190)
+    assert bitcoinacceptor.monero_subaddress_index(MONERO_ADDRESS) == (0, 0)
+    assert bitcoinacceptor.monero_subaddress_index("nope") is None
+    cached = bitcoinacceptor.cache.load(
+        bitcoinacceptor.CACHE_PATH, "xmr_subaddress", f"{MONERO_ADDRESS}:0:190"
+    )
+    assert cached == MONERO_SUBADDRESS_190
+    bitcoinacceptor.cache.close()
 
 
 def test_fiat_per_coin():
@@ -387,3 +432,590 @@ def test_empty_address_fiat():
         "bsv",
     )
     assert payment.txid is False
+
+
+def test_cache(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    assert bitcoinacceptor.cache.load(None, "rate", "btc") is None
+    bitcoinacceptor.cache.store(path, "rate", "btc", 10000.0, ttl=60)
+    bitcoinacceptor.cache.store(path, "rate", "bch", 1000.0, ttl=-1)
+    bitcoinacceptor.cache.store(path, "xmr_subaddress", "foo", "bar")
+    bitcoinacceptor.cache.store_many(
+        path, "xmr_subaddress", [("foo2", "bar2"), ("foo3", "bar3")]
+    )
+    bitcoinacceptor.cache.store_many(path, "rate", [("bsv", 100.0)], ttl=-1)
+    # Simulate a restart.
+    bitcoinacceptor.cache.close()
+    assert bitcoinacceptor.cache.load(path, "rate", "btc") == 10000.0
+    assert bitcoinacceptor.cache.load(path, "rate", "bch") is None
+    assert bitcoinacceptor.cache.load(path, "xmr_subaddress", "foo") == "bar"
+    assert bitcoinacceptor.cache.load(path, "xmr_subaddress", "foo3") == "bar3"
+    assert bitcoinacceptor.cache.load(path, "rate", "bsv") is None
+    bitcoinacceptor.cache.close()
+
+
+@patch("bitcoinacceptor.bit.network.NetworkAPI.get_unspent")
+def test_cached_unspents(mock_get_unspent, tmp_path, monkeypatch):
+    monkeypatch.setattr(bitcoinacceptor, "CACHE_PATH", str(tmp_path / "cache.sqlite"))
+    mock_get_unspent.return_value = [
+        Unspent(
+            amount=10721, confirmations=1, script="script", txid="txid1", txindex=1
+        ),
+        Unspent(
+            amount=10357, confirmations=7, script="script", txid="txid4", txindex=1
+        ),
+    ]
+    for _ in range(2):
+        payment = bitcoinacceptor.payment(
+            "16jCrzcXo2PxadrQiQwUgwrmEwDGQYBwZq",
+            10000,
+            "cab41de5-ad64-446d-9ab4-6dc794162bfc",
+        )
+        assert payment.txid == "txid1"
+        # Simulate a restart.
+        bitcoinacceptor.cache.close()
+    assert mock_get_unspent.call_count == 1
+    # Past MAX_CONFIRMATIONS, so never stored.
+    cached = bitcoinacceptor.cache.load(
+        bitcoinacceptor.CACHE_PATH,
+        "unspents",
+        "btc:16jCrzcXo2PxadrQiQwUgwrmEwDGQYBwZq",
+    )
+    assert cached == [[10721, "txid1", 1]]
+    bitcoinacceptor.cache.close()
+
+
+def test_simulated_chain():
+    chain = simulator.SimulatedChain()
+    txid = chain.pay("address", 10721)
+    assert chain("address", "btc") == [[10721, txid, 0]]
+    chain.mine()
+    assert chain("address", "btc") == [[10721, txid, 1]]
+    for _ in range(bitcoinacceptor.MAX_CONFIRMATIONS):
+        chain.mine()
+    assert chain("address", "btc") == []
+    assert chain("other", "btc") == []
+    assert chain.calls == 4
+
+
+def test_simulate():
+    report = simulator.simulate(
+        duration=120,
+        invoice_rate=0.1,
+        volatility=0,
+        pay_probability=1,
+        invoice_ttl=600,
+        min_confirmations=0,
+        seed=1,
+    )
+    assert report.invoices > 0
+    assert report.paid == report.invoices
+    assert report.accepted + report.missed == report.paid
+    assert report.wrong == 0
+    assert report.upstream_calls > report.accepted
+    assert report.latency[50] <= report.latency[99]
+    # Leaves things how it found them.
+    assert bitcoinacceptor.UNSPENTS_BACKEND is None
+    # Price moves make for collisions between the current and quoted
+    # prices, which have to count as ambiguous too.
+    report = simulator.simulate(
+        duration=300,
+        invoice_rate=0.5,
+        cents=(500,),
+        volatility=0.01,
+        price_interval=10,
+        pay_probability=1,
+        invoice_ttl=600,
+        min_confirmations=0,
+        seed=1,
+    )
+    assert report.wrong > 0
+    assert report.ambiguous >= report.wrong
+    assert bitcoinacceptor._fiat_satoshis_to_try("btc", 100, 1000, 2000) == (
+        [100000, 50000],
+        False,
+    )
+    assert bitcoinacceptor._fiat_satoshis_to_try("btc", 100, 20000, 20000) == (
+        [bitcoinacceptor.SATOSHI_FLOOR],
+        True,
+    )
+
+
+def test_multi_fiat_payment(monkeypatch):
+    def backend(address, currency):
+        if currency == "bch":
+            raise ConnectionError("bch explorer is down")
+        if currency == "bsv":
+            sleep(1)
+        return [[10721, "txid1", 1]]
+
+    monkeypatch.setattr(bitcoinacceptor, "UNSPENTS_BACKEND", backend)
+    with pytest.raises(ValueError):
+        bitcoinacceptor.multi_fiat_payment(100, "unique", {"eth": "address"})
+    payments = bitcoinacceptor.multi_fiat_payment(
+        100,
+        "cab41de5-ad64-446d-9ab4-6dc794162bfc",
+        {
+            "btc": "16jCrzcXo2PxadrQiQwUgwrmEwDGQYBwZq",
+            "bch": "bitcoincash:qqwmyjjplsqwltkcgyeagqpjspaaksz3qggnfug7gy",
+            "bsv": "16jCrzcXo2PxadrQiQwUgwrmEwDGQYBwZq",
+        },
+        prices={"btc": (10000, 10001), "bch": (1000, 1001), "bsv": (1000, 1001)},
+        deadline={"btc": 5, "bch": 5, "bsv": 0.1},
+    )
+    assert payments["btc"].status == "ok"
+    assert payments["btc"].payment.txid == "txid1"
+    assert payments["btc"].payment.satoshis == 10721
+    assert payments["bch"].status == "error"
+    assert payments["bch"].payment is None
+    assert payments["bsv"].status == "pending"
+    assert payments["bsv"].payment is None
+
+
+def test_iter_json_array():
+    data = b' [{"a": 1}, {"b": "\xc3\xa9"} ,{"c": [1, 2]}]'
+    for size in range(1, len(data) + 1):
+        chunks = [data[i:][:size] for i in range(0, len(data), size)]
+        elements = list(explorer.iter_json_array(chunks))
+        assert elements == [{"a": 1}, {"b": "é"}, {"c": [1, 2]}]
+    assert list(explorer.iter_json_array([b"[]"])) == []
+    # Numbers cut off between chunks.
+    assert list(explorer.iter_json_array([b"[1, 2", b"3]"])) == [1, 23]
+    assert list(explorer.iter_json_array([b"[1, 2", b"3", b"4, tr", b"ue]"])) == [
+        1,
+        234,
+        True,
+    ]
+    with pytest.raises(ValueError):
+        list(explorer.iter_json_array([b'{"a": 1}']))
+    with pytest.raises(ValueError):
+        list(explorer.iter_json_array([b'[{"a": 1}, {"b"']))
+
+
+class FakeResponse:
+    def __init__(self, text=None, chunks=None):
+        self.text = text
+        self.chunks = chunks
+        self.read = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size):
+        for chunk in self.chunks:
+            self.read += 1
+            yield chunk
+
+
+def esplora_utxo(txid, value, block_height=None):
+    status = {"confirmed": block_height is not None}
+    if block_height is not None:
+        status["block_height"] = block_height
+    utxo = {"txid": txid * 64, "vout": 0, "status": status, "value": value}
+    return bytes(json.dumps(utxo), "utf-8")
+
+
+@patch("bitcoinacceptor.transport.get")
+def test_esplora_unspents(mock_get, monkeypatch):
+    monkeypatch.setattr(
+        bitcoinacceptor, "ESPLORA_ENDPOINTS", {"btc": "https://esplora/api/"}
+    )
+    # Tip is 100.
+    utxos = FakeResponse(
+        chunks=[
+            b"[",
+            esplora_utxo("a", 10721),
+            b",",
+            esplora_utxo("b", 10721, 100),
+            b",",
+            esplora_utxo("c", 10721, 50),
+            b",",
+            esplora_utxo("d", 10721, 99),
+            b",",
+            esplora_utxo("e", 10081, 99),
+            b"]",
+        ]
+    )
+    mock_get.side_effect = [FakeResponse(text="100"), utxos]
+    payment = bitcoinacceptor.payment(
+        "16jCrzcXo2PxadrQiQwUgwrmEwDGQYBwZq",
+        10000,
+        "cab41de5-ad64-446d-9ab4-6dc794162bfc",
+    )
+    assert payment.txid == "b" * 64
+    # Read the small remainder so the connection can be reused.
+    assert utxos.read == len(utxos.chunks)
+
+    # Too much left, so stopped reading.
+    monkeypatch.setattr(explorer, "DRAIN_LIMIT", 0)
+    utxos = FakeResponse(chunks=utxos.chunks)
+    mock_get.side_effect = [FakeResponse(text="100"), utxos]
+    payment = bitcoinacceptor.payment(
+        "16jCrzcXo2PxadrQiQwUgwrmEwDGQYBwZq",
+        10000,
+        "cab41de5-ad64-446d-9ab4-6dc794162bfc",
+    )
+    assert payment.txid == "b" * 64
+    assert utxos.read < len(utxos.chunks)
+
+    mock_get.side_effect = [FakeResponse(text="100"), FakeResponse(chunks=utxos.chunks)]
+    unspents = explorer.fetch_unspents(
+        "https://esplora/api/", "address", 1, bitcoinacceptor.MAX_CONFIRMATIONS
+    )
+    assert len(unspents) == 3
+    assert list(unspents) == [
+        (10721, "b" * 64, 1),
+        (10721, "d" * 64, 2),
+        (10081, "e" * 64, 2),
+    ]
+
+
+def test_transport():
+    session = transport.session()
+    assert transport.session() is session
+    adapter = session.get_adapter("https://blockstream.info/api/")
+    assert adapter._pool_maxsize == transport.POOL_MAXSIZE
+    assert session.proxies == {}
+    # bit's explorer calls go through our session.
+    assert isinstance(bit.network.services.requests, transport._PooledRequests)
+    assert bit.network.services.requests.Session is requests.Session
+    # bitcash's own session and bitsv's explorers too.
+    assert isinstance(bitcash.network.http.session, transport._PooledSession)
+    assert isinstance(bitcash.network.rates.session, transport._PooledSession)
+    assert bitcash.network.http.session.headers is transport.session().headers
+    assert isinstance(bitsv.network.rates.requests, transport._PooledRequests)
+    assert isinstance(
+        bitsv.network.services.mattercloud.requests, transport._PooledRequests
+    )
+    assert isinstance(whatsonchain.api.requests, transport._PooledRequests)
+
+    transport.configure(pool_maxsize=20, socks_proxy="socks5h://127.0.0.1:9050")
+    try:
+        new_session = transport.session()
+        assert new_session is not session
+        adapter = new_session.get_adapter("https://blockstream.info/api/")
+        assert adapter._pool_maxsize == 20
+        assert new_session.proxies["https"] == "socks5h://127.0.0.1:9050"
+        proxies = {
+            "http": "socks5h://127.0.0.1:9050",
+            "https": "socks5h://127.0.0.1:9050",
+        }
+        with patch.object(new_session, "get") as mock_get:
+            transport.get("https://example.com/")
+            mock_get.assert_called_with(
+                "https://example.com/", timeout=transport.TIMEOUT, proxies=proxies
+            )
+            # bit's own per explorer timeouts are left alone.
+            bit.network.services.requests.get("https://example.com/", timeout=5)
+            mock_get.assert_called_with(
+                "https://example.com/", timeout=5, proxies=proxies
+            )
+            bit.network.services.requests.get("https://example.com/")
+            mock_get.assert_called_with(
+                "https://example.com/", timeout=transport.TIMEOUT, proxies=proxies
+            )
+    finally:
+        transport.configure(pool_maxsize=10, socks_proxy=False)
+    assert transport.session().proxies == {}
+
+
+def test_shared_unspents():
+    calls = []
+
+    def fetch(address, currency):
+        calls.append(address)
+        sleep(0.2)
+        return [[10721, "txid1", 1]]
+
+    shared = service.SharedUnspents(fetch, ttl=60)
+    threads = [
+        threading.Thread(target=shared, args=("address", "btc")) for _ in range(5)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert shared("address", "btc") == [[10721, "txid1", 1]]
+    assert calls == ["address"]
+    assert shared.upstream_calls == 1
+    shared("other", "btc")
+    assert calls == ["address", "other"]
+    # Stale entries are dropped as new ones come in.
+    shared.ttl = 0.1
+    sleep(0.15)
+    shared("third", "btc")
+    assert list(shared._fetched) == [("btc", "third")]
+
+
+async def http(port, method, path, payload=None):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    body = b""
+    if payload is not None:
+        body = bytes(json.dumps(payload), "utf-8")
+    head = f"{method} {path} HTTP/1.1\r\nContent-Length: {len(body)}\r\n\r\n"
+    writer.write(bytes(head, "latin-1") + body)
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    head, _, body = response.partition(b"\r\n\r\n")
+    return int(head.split()[1]), json.loads(body)
+
+
+def test_service():
+    address = "16jCrzcXo2PxadrQiQwUgwrmEwDGQYBwZq"
+    unique = "cab41de5-ad64-446d-9ab4-6dc794162bfc"
+    chain = simulator.SimulatedChain()
+    payment_service = service.PaymentService(
+        backend=chain, rates=service.FAKE_RATES.get, ttl=0.5, poll_interval=0.1
+    )
+
+    async def run():
+        server = await payment_service.start("127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        events_reader, events_writer = await asyncio.open_connection("127.0.0.1", port)
+        events_writer.write(b"GET /events HTTP/1.1\r\n\r\n")
+        try:
+            status, invoice = await http(
+                port,
+                "POST",
+                "/quotes",
+                {
+                    "currency": "btc",
+                    "address": address,
+                    "cents": 100,
+                    "unique": unique,
+                    "price": 10000,
+                },
+            )
+            assert status == 200
+            assert invoice["satoshis"] == 10721
+            assert invoice["status"] == "unpaid"
+            assert invoice["txid"] is None
+            status, invoice = await http(
+                port,
+                "POST",
+                "/quotes",
+                {"currency": "btc", "address": address, "cents": 100, "unique": "b"},
+            )
+            assert status == 200
+            assert invoice["final_price"] is not None
+            status, response = await http(
+                port, "POST", "/invoices/check", {"uniques": [unique, "b", "c"]}
+            )
+            assert status == 200
+            assert response["invoices"][unique]["status"] == "unpaid"
+            assert response["invoices"]["c"] is None
+            # Everything above shared one lookup.
+            assert chain.calls == 1
+
+            status, response = await http(
+                port, "POST", "/fake/pay", {"address": address, "satoshis": 10721}
+            )
+            txid = response["txid"]
+            await http(port, "POST", "/fake/mine")
+            await asyncio.sleep(0.7)
+            status, invoice = await http(port, "GET", f"/invoices/{unique}")
+            assert status == 200
+            assert invoice["status"] == "paid"
+            assert invoice["txid"] == txid
+
+            while True:
+                line = await asyncio.wait_for(events_reader.readline(), 5)
+                if line.startswith(b"data: "):
+                    break
+            event = json.loads(line.split(b" ", 1)[1])
+            assert event["unique"] == unique
+            assert event["status"] == "paid"
+
+            status, _ = await http(port, "GET", "/invoices/nope")
+            assert status == 404
+            status, response = await http(
+                port,
+                "POST",
+                "/quotes",
+                {"currency": "eth", "address": address, "cents": 1, "unique": "d"},
+            )
+            assert status == 400
+            status, response = await http(port, "POST", "/quotes", {"cents": 1})
+            assert status == 400
+        finally:
+            events_writer.close()
+            await payment_service.stop()
+
+    asyncio.run(run())
+    assert bitcoinacceptor.UNSPENTS_BACKEND is None
+
+
+def test_service_expiry(monkeypatch):
+    address = "16jCrzcXo2PxadrQiQwUgwrmEwDGQYBwZq"
+    chain = simulator.SimulatedChain()
+    payment_service = service.PaymentService(
+        backend=chain, rates=service.FAKE_RATES.get, ttl=0, invoice_ttl=60
+    )
+    monkeypatch.setattr(bitcoinacceptor, "UNSPENTS_BACKEND", payment_service.unspents)
+
+    async def run():
+        invoices = {}
+        for unique, cents in (("pending", 100), ("confirmed", 200), ("unpaid", 300)):
+            invoices[unique] = await payment_service.quote(
+                "btc", address, cents, unique, price=10000
+            )
+        chain.pay(address, invoices["confirmed"]["satoshis"])
+        chain.mine()
+        pending_txid = chain.pay(address, invoices["pending"]["satoshis"])
+        for invoice in payment_service.invoices.values():
+            invoice["created"] -= 61
+        # Paid before expiring, so it still counts.
+        assert (await payment_service.check("confirmed"))["status"] == "paid"
+        # Paid but unconfirmed, so wait for it.
+        assert (await payment_service.check("pending"))["status"] == "unpaid"
+        assert (await payment_service.check("unpaid"))["status"] == "expired"
+        chain.mine()
+        invoice = await payment_service.check("pending")
+        assert invoice["status"] == "paid"
+        assert invoice["txid"] == pending_txid
+
+        # A paid invoice can't be settled again by an overlapping check.
+        class Payment:
+            txid = "othertxid"
+
+        payment_service._settle(payment_service.invoices["pending"], Payment)
+        assert payment_service.invoices["pending"]["txid"] == pending_txid
+        assert "othertxid" not in payment_service.accepted_txids
+
+    asyncio.run(run())
+
+
+def test_service_rates():
+    calls = []
+
+    def rates(currency):
+        calls.append(currency)
+        sleep(0.1)
+        return 30000.0
+
+    payment_service = service.PaymentService(
+        backend=simulator.SimulatedChain(), rates=rates
+    )
+
+    async def run():
+        return await asyncio.gather(*[payment_service._rate("btc") for _ in range(20)])
+
+    assert asyncio.run(run()) == [30000.0] * 20
+    assert calls == ["btc"]
+    assert payment_service._rate_tasks == {}
+
+
+def test_service_prune():
+    payment_service = service.PaymentService(
+        backend=simulator.SimulatedChain(), invoice_ttl=60, txid_ttl=600
+    )
+    now = monotonic()
+    payment_service.invoices = {"old": {"created": now - 121}, "new": {"created": now}}
+    payment_service.accepted_txids = {"oldtxid": now - 601, "newtxid": now - 599}
+    payment_service._prune()
+    assert list(payment_service.invoices) == ["new"]
+    assert list(payment_service.accepted_txids) == ["newtxid"]
+
+
+def test_slow_subscriber(monkeypatch):
+    monkeypatch.setattr(service, "MAX_QUEUED_EVENTS", 2)
+    payment_service = service.PaymentService(backend=simulator.SimulatedChain())
+    invoice = {
+        key: None
+        for key in (
+            "unique",
+            "currency",
+            "address",
+            "cents",
+            "satoshis",
+            "uri",
+            "final_price",
+            "status",
+            "txid",
+        )
+    }
+    written = []
+
+    class Writer:
+        def write(self, data):
+            written.append(data)
+
+        async def drain(self):
+            pass
+
+    async def run():
+        events = asyncio.ensure_future(payment_service._events(Writer()))
+        await asyncio.sleep(0)
+        assert len(payment_service._subscribers) == 1
+        for _ in range(3):
+            payment_service._publish(invoice)
+        assert len(payment_service._subscribers) == 0
+        # Hung up on without sending the backlog.
+        await asyncio.wait_for(events, 1)
+
+    asyncio.run(run())
+    assert not any(data.startswith(b"data: ") for data in written)
+
+
+@patch("bitcoinacceptor.Wallet")
+def test_cached_monero_subaddress(mock_wallet, tmp_path, monkeypatch):
+    monkeypatch.setattr(bitcoinacceptor, "CACHE_PATH", str(tmp_path / "cache.sqlite"))
+    w = mock_wallet.return_value
+    w.height.return_value = 1000
+    w.incoming.return_value = []
+
+    def subaddress(unique):
+        address, txid = bitcoinacceptor._monero_unspents(
+            unique, [5], [], "localhost", 18088, "user", "password"
+        )
+        assert txid is False
+        return address
+
+    w.address.return_value = "wallet1"
+    w.get_address.return_value = "wallet1subaddress"
+    assert subaddress("foo") == "wallet1subaddress"
+    w.get_address.return_value = "wallet1other"
+    # Served from the cache.
+    assert subaddress("foo") == "wallet1subaddress"
+    # A different wallet behind the same host and port.
+    w.address.return_value = "wallet2"
+    w.get_address.return_value = "wallet2subaddress"
+    assert subaddress("foo") == "wallet2subaddress"
+    cached = bitcoinacceptor.cache.load(
+        bitcoinacceptor.CACHE_PATH, "xmr_subaddress", "wallet1:0:190"
+    )
+    assert cached == "wallet1subaddress"
+    bitcoinacceptor.cache.close()
+    # Without a cache there's no key to build, so no primary address lookup.
+    monkeypatch.setattr(bitcoinacceptor, "CACHE_PATH", None)
+    w.address.reset_mock()
+    assert subaddress("foo") == "wallet2subaddress"
+    w.address.assert_not_called()
+
+
+def test_monero_socks_proxy():
+    sent = []
+
+    def send(request, **kwargs):
+        sent.append((request.url, kwargs["proxies"]))
+        raise requests.exceptions.ConnectionError("Not really sending.")
+
+    transport.configure(socks_proxy="socks5h://127.0.0.1:9050")
+    try:
+        with patch("requests.adapters.HTTPAdapter.send", side_effect=send):
+            with pytest.raises(requests.exceptions.ConnectionError):
+                bitcoinacceptor._monero_unspents(
+                    "foo", [5], [], "abc.onion", 18088, "user", "password"
+                )
+    finally:
+        transport.configure(socks_proxy=False)
+    url, proxies = sent[0]
+    assert url == "http://abc.onion:18088/json_rpc"
+    assert proxies["http"] == "socks5h://127.0.0.1:9050"